@@ -1,15 +1,29 @@
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
+import shutil
 import ftplib
 import dotenv
 
 dotenv.load_dotenv()
 
+HTTP_DOWNLOAD_WORKERS = 16
+FTP_DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class ClimateDataDownloader:
     def __init__(self):
-        pass
+        # Shared session so connections are reused across downloads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_DOWNLOAD_WORKERS, pool_maxsize=HTTP_DOWNLOAD_WORKERS
+        )
+        self.session.mount("https://", adapter)
 
     def _calculate_end_date(self, start_date_str: str):
         """
@@ -39,12 +53,30 @@ class ClimateDataDownloader:
 
     def _download_file(self, url: str, save_path: str):
         """Downloads a file from a given URL and saves it to the specified path."""
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Check for HTTP errors
-
-        with open(save_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()  # Check for HTTP errors
+            response.raw.decode_content = True
+
+            try:
+                with open(save_path, "wb") as f:
+                    # Reserve the full file size up front to avoid fragmentation
+                    content_length = response.headers.get("content-length")
+                    if content_length and hasattr(os, "posix_fallocate"):
+                        os.posix_fallocate(f.fileno(), 0, int(content_length))
+                    shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                    f.truncate()
+            except BaseException as e:
+                # Don't leave a partial, zero padded file behind
+                if os.path.exists(save_path):
+                    os.remove(save_path)
+                # Raise the same errors as response.iter_content would
+                if isinstance(e, urllib3.exceptions.ProtocolError):
+                    raise requests.exceptions.ChunkedEncodingError(e) from e
+                if isinstance(e, urllib3.exceptions.DecodeError):
+                    raise requests.exceptions.ContentDecodingError(e) from e
+                if isinstance(e, urllib3.exceptions.ReadTimeoutError):
+                    raise requests.exceptions.ConnectionError(e) from e
+                raise
 
         print(f"File '{os.path.basename(save_path)}' saved to '{save_path}'")
 
@@ -72,18 +104,46 @@ class ClimateDataDownloader:
 
         base_url = "https://esgf.dwd.de/thredds/fileServer/esgf3_1/climatepredictionsde"
 
-        for variable in variables:
-            for ensemble in ensembles:
+        # Ordered by ensemble so each ensemble's files are requested together
+        download_tasks = []
+        for ensemble in ensembles:
+            # Create the subfolder if it doesn't exist
+            subfolder_path = os.path.join(target_folder, start_date_str, ensemble)
+            os.makedirs(subfolder_path, exist_ok=True)
+
+            for variable in variables:
                 folder_path = f"{experiment}/output/public/{domain}/DWD/{driving_model}/{cast_package}/{cast_type}/{ensemble}/DWD-EPISODES2022/v1-r1/day/{variable}/{version}"
                 file_name = f"{variable}_day_{driving_model}--DWD-EPISODES2022--{domain}_{cast_type}_{ensemble}_{start_date_str}-{end_date_str}.nc"
                 download_url = f"{base_url}/{folder_path}/{file_name}"
 
-                # Create the subfolder if it doesn't exist
-                subfolder_path = os.path.join(target_folder, start_date_str, ensemble)
-                os.makedirs(subfolder_path, exist_ok=True)
-
                 save_path = os.path.join(subfolder_path, file_name)
-                self._download_file(download_url, save_path)
+                download_tasks.append((download_url, save_path))
+
+        with ThreadPoolExecutor(max_workers=HTTP_DOWNLOAD_WORKERS) as executor:
+            list(executor.map(lambda task: self._download_file(*task), download_tasks))
+
+    @contextmanager
+    def _connect_ftp(self, ftp_hostname: str, ftp_user: str, ftp_password: str):
+        """Opens an FTP_TLS connection in the AMBER directory with a protected data channel."""
+        with ftplib.FTP_TLS(host=ftp_hostname) as ftps:
+            ftps.login(user=ftp_user, passwd=ftp_password)
+            ftps.prot_p()
+            ftps.cwd("DWD_SpreeWasser_N")
+            yield ftps
+
+    def _download_ftp_files(
+        self,
+        files: list[tuple[str, str]],
+        ftp_hostname: str,
+        ftp_user: str,
+        ftp_password: str,
+    ):
+        """Downloads (filename, local path) pairs over a single FTP_TLS connection."""
+        with self._connect_ftp(ftp_hostname, ftp_user, ftp_password) as ftps:
+            for filename, local_filepath in files:
+                with open(local_filepath, "wb") as file:
+                    ftps.retrbinary("RETR " + filename, file.write)
+                print(f"Downloaded: {filename}. Saved to: {local_filepath}")
 
     def retrieve_amber_files(self, target_folder: str, start_year: int, end_year: int, ftp_hostname:str, ftp_user:str, ftp_password:str):
         """Retrieves NetCDF files from an FTP server for the specified year range.
@@ -96,17 +156,28 @@ class ClimateDataDownloader:
         if not (start_year and end_year):
             raise ValueError("Please provide both 'start_year' and 'end_year'.")
 
-        with ftplib.FTP_TLS(host=ftp_hostname) as ftps:
-            ftps.login(user=ftp_user, passwd=ftp_password)
-            ftps.prot_p()
-            ftps.cwd("DWD_SpreeWasser_N")
-
-            for year in range(start_year, end_year + 1):
-                year_str = str(year)
-                for filename in ftps.nlst():
-                    if year_str in filename:
-                        local_filepath = os.path.join(target_folder, year_str, filename)
-                        os.makedirs(os.path.dirname(local_filepath), exist_ok=True)
-                        with open(local_filepath, "wb") as file:
-                            ftps.retrbinary("RETR " + filename, file.write)
-                        print(f"Downloaded: {filename}. Saved to: {local_filepath}")
+        with self._connect_ftp(ftp_hostname, ftp_user, ftp_password) as ftps:
+            filenames = ftps.nlst()
+
+        download_tasks = []
+        for year in range(start_year, end_year + 1):
+            year_str = str(year)
+            for filename in filenames:
+                if year_str in filename:
+                    local_filepath = os.path.join(target_folder, year_str, filename)
+                    os.makedirs(os.path.dirname(local_filepath), exist_ok=True)
+                    download_tasks.append((filename, local_filepath))
+
+        # Each worker downloads its share of the files over its own connection
+        with ThreadPoolExecutor(max_workers=FTP_DOWNLOAD_WORKERS) as executor:
+            list(
+                executor.map(
+                    lambda files: self._download_ftp_files(
+                        files, ftp_hostname, ftp_user, ftp_password
+                    ),
+                    [
+                        download_tasks[i::FTP_DOWNLOAD_WORKERS]
+                        for i in range(min(FTP_DOWNLOAD_WORKERS, len(download_tasks)))
+                    ],
+                )
+            )
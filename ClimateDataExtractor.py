@@ -1,38 +1,165 @@
 import os
 import time
-import glob
+import json
 import pickle
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import fsspec
 import pandas as pd
 import xarray as xr
 import numpy as np
 import lz4.frame
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from grid_utils import nearest_indices
+
+# Dask chunking for lazily opened NetCDF files: whole time series per chunk so a
+# point gather touches one chunk per variable and lat/lon tile.
+NETCDF_CHUNKS = {"time": -1, "lat": 64, "lon": 64}
+
 
 class ClimateDataExtractor:
     def __init__(self):
         self.amber_ds = None
         self.forecast_ds = None
 
-    def _convert_forecast_to_amber_units(self, forecast_df: pd.DataFrame):
-        """Converts forecast data units to match amber data units."""
-        forecast_df[["tas", "tasmax", "tasmin"]] -= 273.15  # Kelvin to Celsius
-        forecast_df[["rsds"]] *= 24  # Daily mean to total daily radiation
-        return forecast_df
+    def _convert_forecast_to_amber_units(
+        self, forecast_values: np.ndarray, variables: list[str]
+    ):
+        """Converts a (..., variable, time, point) forecast array to amber units in place."""
+        # Kelvin to Celsius, one basic slice per variable: a list index would
+        # gather the planes into a copy and scatter it back
+        for temperature in ("tas", "tasmax", "tasmin"):
+            forecast_values[..., variables.index(temperature), :, :] -= 273.15
+        # Daily mean to total daily radiation
+        forecast_values[..., variables.index("rsds"), :, :] *= 24
+        return forecast_values
+
+    def _gather_points(
+        self,
+        dataset: xr.Dataset,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        variables: list[str],
+    ):
+        """Gathers the time series of many lat/lons in a single computation.
+
+        Returns the iso-date index and an array of shape (variable, time, point),
+        with a leading ensemble axis if the dataset has an ensemble dimension.
+        """
+        lat_idx = nearest_indices(dataset.lat.values, lats)
+        lon_idx = nearest_indices(dataset.lon.values, lons)
+
+        # One gather for all points, reading only the chunks that cover them
+        points_ds = (
+            dataset[variables]
+            .isel(
+                lat=xr.DataArray(lat_idx, dims="point"),
+                lon=xr.DataArray(lon_idx, dims="point"),
+            )
+            .compute()
+        )
+        dims = ["variable", "time", "point"]
+        if "ensemble" in points_ds.dims:
+            dims.insert(0, "ensemble")
+        # NetCDF variables are float32 on disk; keep them that way downstream
+        values = points_ds.to_array().transpose(*dims).values.astype(
+            np.float32, copy=False
+        )
+        iso_dates = pd.Index(
+            dataset.time.values.astype("datetime64[D]"), name="iso-date"
+        )
+        return iso_dates, values
+
+    def _points_to_dataframes(
+        self,
+        iso_dates: pd.Index,
+        values: np.ndarray,
+        variables: list[str],
+    ):
+        """Splits a (variable, time, point) array into one DataFrame per point id.
+
+        Point ids are positions in the requested lat/lon array.
+        """
+        df_dict = {}
+        for point in range(values.shape[2]):
+            df_dict[point] = pd.DataFrame(
+                values[:, :, point].T, index=iso_dates, columns=variables
+            )
+        return df_dict
 
-    def _extract_point_data(
-        self, dataset: xr.Dataset, lat: float, lon: float, variables: list[str]
+    def _extract_points_bulk(
+        self,
+        dataset: xr.Dataset,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        variables: list[str],
     ):
-        """Extracts time series data for specified variables at a lat/lon."""
-        df = dataset[variables].sel(lat=lat, lon=lon, method="nearest").to_dataframe()
-        df["iso-date"] = pd.to_datetime(df.index).date
-        return df.set_index("iso-date")[variables]
+        """Extracts time series data for specified variables at many lat/lons."""
+        iso_dates, values = self._gather_points(dataset, lats, lons, variables)
+        return self._points_to_dataframes(iso_dates, values, variables)
 
-    def _combine_dataframes(self, amber_df: pd.DataFrame, forecast_df: pd.DataFrame):
+    def _overlap_cut(
+        self,
+        amber_dates: np.ndarray,
+        amber_values: np.ndarray,
+        forecast_dates: np.ndarray,
+    ):
+        """Finds where amber and forecast series are joined, given int64 day numbers.
+
+        Returns the number of leading amber rows to keep (up to the last row with a
+        valid value) and the index of the first forecast row after them.
+        """
+        valid_rows = np.flatnonzero(~np.isnan(amber_values).all(axis=1))
+        amber_end = valid_rows[-1] + 1 if valid_rows.size else len(amber_dates)
+        if amber_end == 0:
+            return 0, 0
+        forecast_start = np.searchsorted(
+            forecast_dates, amber_dates[amber_end - 1], side="right"
+        )
+        return amber_end, forecast_start
+
+    def _day_numbers(self, dates: pd.Index):
+        """Converts a date index to int64 day numbers for _overlap_cut."""
+        return np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+
+    def _combine_arrays(
+        self,
+        amber_dates: pd.Index,
+        amber_days: np.ndarray,
+        amber_values: np.ndarray,
+        forecast_dates: pd.Index,
+        forecast_days: np.ndarray,
+        forecast_values: np.ndarray,
+    ):
+        """Joins (time, variable) amber and forecast arrays, removing overlaps.
+
+        The day numbers of both date indexes are passed in so callers joining
+        many points convert them once. Returns the combined date index and values.
+        """
+        amber_end, forecast_start = self._overlap_cut(
+            amber_days, amber_values, forecast_days
+        )
+        return (
+            amber_dates[:amber_end].append(forecast_dates[forecast_start:]),
+            np.concatenate(
+                [amber_values[:amber_end], forecast_values[forecast_start:]], axis=0
+            ),
+        )
+
+    def _combine_dataframes(
+        self, amber_df: pd.DataFrame, forecast_df: pd.DataFrame
+    ):
         """Combines amber and forecast dataframes, removing overlaps."""
-        last_valid_amber = amber_df.last_valid_index()
-        amber_df = amber_df.loc[:last_valid_amber]
-        combined_df = pd.concat([amber_df, forecast_df], axis=0)
-        return combined_df[~combined_df.index.duplicated(keep="first")]
+        index, values = self._combine_arrays(
+            amber_df.index,
+            self._day_numbers(amber_df.index),
+            amber_df.to_numpy(),
+            forecast_df.index,
+            self._day_numbers(forecast_df.index),
+            forecast_df[amber_df.columns].to_numpy(),
+        )
+        return pd.DataFrame(values, index=index, columns=amber_df.columns)
 
     def _load_amber_data(
         self,
@@ -52,19 +179,58 @@ class ClimateDataExtractor:
         if not file_paths:
             print(f"No matching files found for years {start_year} to {end_year}.")
             return None
-        return xr.open_mfdataset(file_paths)
+        return xr.open_mfdataset(
+            file_paths, chunks=NETCDF_CHUNKS, parallel=True, combine="by_coords"
+        )
+
+    def _open_netcdf(self, file_path: str, chunks: dict):
+        """Opens a NetCDF file lazily, through its Kerchunk reference file if usable."""
+        reference_file = f"{file_path}.json"
+        # References older than the file describe an earlier merge
+        if os.path.exists(reference_file) and os.path.getmtime(
+            reference_file
+        ) >= os.path.getmtime(file_path):
+            with open(reference_file) as f:
+                references = json.load(f)
+            targets = {
+                ref[0].removeprefix("file://")
+                for ref in references.get("refs", references).values()
+                if isinstance(ref, list)
+            }
+            if all(os.path.exists(target) for target in targets):
+                mapper = fsspec.get_mapper("reference://", fo=references)
+                return xr.open_dataset(
+                    mapper, engine="zarr", consolidated=False, chunks=chunks
+                )
+            print(f"Ignoring {reference_file}: it points to missing files.")
+        return xr.open_dataset(file_path, chunks=chunks)
 
     def _load_forecast_data(
-        self, folder_pattern: str, file_name_pattern: str, ensemble: str
+        self, folder_pattern: str, file_name_pattern: str, ensembles: list[str]
     ):
-        """Loads NetCDF files within the year range into an xarray dataset."""
-        folder = folder_pattern.format(ensemble=ensemble)
-        file_path = os.path.join(folder, file_name_pattern.format(ensemble=ensemble))
+        """Loads the ensemble NetCDF files into one dataset with an ensemble dimension."""
+        file_paths = []
+        found_ensembles = []
+        for ensemble in ensembles:
+            folder = folder_pattern.format(ensemble=ensemble)
+            file_path = os.path.join(folder, file_name_pattern.format(ensemble=ensemble))
+            if os.path.exists(file_path):
+                file_paths.append(file_path)
+                found_ensembles.append(ensemble)
+            else:
+                print(f"No matching files found for ensemble {ensemble}.")
 
-        if not os.path.exists(file_path):
-            print(f"No matching files found for ensemble {ensemble}.")
+        if not file_paths:
             return None
-        return xr.open_dataset(file_path)
+        datasets = [
+            self._open_netcdf(file_path, NETCDF_CHUNKS) for file_path in file_paths
+        ]
+        combined = xr.concat(
+            datasets, dim=pd.Index(found_ensembles, name="ensemble")
+        )
+        # concat doesn't carry over the file handles; close them with the result
+        combined.set_close(lambda: [dataset.close() for dataset in datasets])
+        return combined
 
     def extract_amber_data(
         self,
@@ -76,28 +242,28 @@ class ClimateDataExtractor:
         ndarray_of_valid_lat_lon_tuples,
         max_points: int = None,
     ):
+        """Extracts the amber points as {point: df}.
 
+        Use extract_combined when the amber and forecast series are combined anyway.
+        """
         self.amber_ds = self._load_amber_data(
             netcdf_folder_pattern, file_name_pattern, start_year, end_year
-        ).load()
+        )
 
-        if not self.amber_ds:
+        if self.amber_ds is None:
             return {}
 
-        amber_df_dict = {}
+        points = ndarray_of_valid_lat_lon_tuples[: max_points or None]
         start_time = time.time()
 
-        for count, (lat, lon) in enumerate(ndarray_of_valid_lat_lon_tuples):
-
-            if max_points and count >= max_points:
-                break  # Stop processing if max_points limit is reached
-
-            amber_df = self._extract_point_data(self.amber_ds, lat, lon, variables)
-
-            amber_df_dict[f"{lat},{lon}"] = amber_df
+        amber_df_dict = self._extract_points_bulk(
+            self.amber_ds, points["lat"], points["lon"], variables
+        )
 
         self.amber_ds.close()
-        print(f"Processed {count } points in {time.time() - start_time:.2f} seconds.")
+        print(
+            f"Processed {len(amber_df_dict)} points in {time.time() - start_time:.2f} seconds."
+        )
         return amber_df_dict
 
     def extract_forecast_data(
@@ -106,64 +272,200 @@ class ClimateDataExtractor:
         variables: list[str],
         file_name_pattern: str,
         ndarray_of_valid_lat_lon_tuples,
-        ensemble: str,
+        ensembles: list[str],
         max_points: int = None,
     ):
+        """Extracts the forecast points of all ensembles as {ensemble: {point: df}}.
 
+        Use extract_combined when the amber and forecast series are combined anyway.
+        """
         self.forecast_ds = self._load_forecast_data(
-            netcdf_folder_pattern, file_name_pattern, ensemble=ensemble
-        ).load()
+            netcdf_folder_pattern, file_name_pattern, ensembles=ensembles
+        )
 
-        if not self.forecast_ds:
+        if self.forecast_ds is None:
             return {}
 
-        forecast_df_dict = {}
+        points = ndarray_of_valid_lat_lon_tuples[: max_points or None]
+        lats, lons = points["lat"], points["lon"]
         start_time = time.time()
 
-        for count, (lat, lon) in enumerate(ndarray_of_valid_lat_lon_tuples):
-
-            if max_points and count >= max_points:
-                break  # Stop processing if max_points limit is reached
+        # Gather all ensembles at once: (ensemble, variable, time, point)
+        iso_dates, values = self._gather_points(self.forecast_ds, lats, lons, variables)
+        self._convert_forecast_to_amber_units(values, variables)
 
-            forecast_df = self._extract_point_data(
-                self.forecast_ds, lat, lon, variables
+        forecast_df_dict = {}
+        for ensemble, ensemble_values in zip(self.forecast_ds.ensemble.values, values):
+            forecast_df_dict[ensemble] = self._points_to_dataframes(
+                iso_dates, ensemble_values, variables
             )
-            forecast_df = self._convert_forecast_to_amber_units(forecast_df.copy())
-
-            forecast_df_dict[f"{lat},{lon}"] = forecast_df
 
         self.forecast_ds.close()
-        print(f"Processed {count } points in {time.time() - start_time:.2f} seconds.")
+        print(
+            f"Processed {len(points)} points of {len(forecast_df_dict)} ensembles in {time.time() - start_time:.2f} seconds."
+        )
         return forecast_df_dict
-    
-    def save_data(self, data_dict: dict, directory_name:str, file_name: str):
-        """Saves the data dictionary to a compressed pickle file."""
+
+    def extract_combined(
+        self,
+        amber_folder_pattern: str,
+        amber_file_name_pattern: str,
+        start_year: int,
+        end_year: int,
+        forecast_folder_pattern: str,
+        forecast_file_name_pattern: str,
+        ensembles: list[str],
+        variables: list[str],
+        ndarray_of_valid_lat_lon_tuples,
+        max_points: int = None,
+    ):
+        """Extracts amber and forecast points in one pass as {ensemble: {point: df}}.
+
+        Each point's amber series is followed by the forecast from the day after
+        its last valid amber row; DataFrames are only built for the combined result.
+        """
+        self.amber_ds = self._load_amber_data(
+            amber_folder_pattern, amber_file_name_pattern, start_year, end_year
+        )
+        self.forecast_ds = self._load_forecast_data(
+            forecast_folder_pattern, forecast_file_name_pattern, ensembles=ensembles
+        )
+
+        if self.amber_ds is None or self.forecast_ds is None:
+            for dataset in (self.amber_ds, self.forecast_ds):
+                if dataset is not None:
+                    dataset.close()
+            return {}
+
+        points = ndarray_of_valid_lat_lon_tuples[: max_points or None]
+        lats, lons = points["lat"], points["lon"]
+        start_time = time.time()
+
+        # (variable, time, point) and (ensemble, variable, time, point)
+        amber_dates, amber_values = self._gather_points(
+            self.amber_ds, lats, lons, variables
+        )
+        forecast_dates, forecast_values = self._gather_points(
+            self.forecast_ds, lats, lons, variables
+        )
+        self._convert_forecast_to_amber_units(forecast_values, variables)
+
+        amber_days = self._day_numbers(amber_dates)
+        forecast_days = self._day_numbers(forecast_dates)
+
+        combined_df_dict = {}
+        for ensemble, ensemble_values in zip(
+            self.forecast_ds.ensemble.values, forecast_values
+        ):
+            point_df_dict = {}
+            for point in range(len(points)):
+                index, values = self._combine_arrays(
+                    amber_dates,
+                    amber_days,
+                    amber_values[:, :, point].T,
+                    forecast_dates,
+                    forecast_days,
+                    ensemble_values[:, :, point].T,
+                )
+                point_df_dict[point] = pd.DataFrame(
+                    values, index=index, columns=variables
+                )
+            combined_df_dict[ensemble] = point_df_dict
+
+        self.amber_ds.close()
+        self.forecast_ds.close()
+        print(
+            f"Processed {len(points)} points of {len(combined_df_dict)} ensembles in {time.time() - start_time:.2f} seconds."
+        )
+        return combined_df_dict
+
+    def _point_table(self, point_id: int, df: pd.DataFrame):
+        """Converts one point's DataFrame to an Arrow table with a point_id column."""
+        table = pa.Table.from_pandas(
+            df.rename_axis("iso-date").reset_index(), preserve_index=False
+        )
+        return table.add_column(
+            0, "point_id", pa.array(np.full(len(df), point_id, dtype=np.int64))
+        )
+
+    def save_data(
+        self,
+        data_dict: dict,
+        directory_name: str,
+        file_name: str,
+        legacy: bool = False,
+        lat_lon_table: np.ndarray = None,
+    ):
+        """Saves the data dictionary to a Parquet file with one row group per point.
+
+        With legacy=True the dictionary is written as an lz4 compressed pickle.
+        If given, lat_lon_table (point id -> (lat, lon)) is saved next to the file.
+        """
         os.makedirs(directory_name, exist_ok=True)
         file_path = os.path.join(directory_name, file_name)
-        with lz4.frame.open(file_path, "wb") as f:
-            t0 = time.time()
-            pickle.dump(data_dict, f)
-            t1 = time.time()
-            print(f"Saved file {file_path} in {t1 - t0:.2f} seconds")
-
-    def load_data(self, file_path: str):
-        """Loads the data dictionary from a compressed pickle file."""
-        with lz4.frame.open(file_path, "rb") as f:
-            t0 = time.time()
-            data_dict = pickle.load(f)
-            t1 = time.time()
-            print(f"Loaded file {file_path} in {t1 - t0:.2f} seconds")
-        return data_dict
+        t0 = time.time()
+        if not legacy:
+            # Points without rows have nothing to store
+            point_tables = [
+                self._point_table(point_id, df)
+                for point_id, df in data_dict.items()
+                if len(df)
+            ]
+            if not point_tables:
+                print(f"No data to save to {file_path}.")
+                return
+        if lat_lon_table is not None:
+            np.save(f"{file_path}.lat_lon_table.npy", np.asarray(lat_lon_table))
+        if legacy:
+            with lz4.frame.open(file_path, "wb") as f:
+                pickle.dump(data_dict, f)
+        else:
+            with pq.ParquetWriter(
+                file_path,
+                point_tables[0].schema,
+                compression="lz4",
+                use_dictionary=True,
+            ) as writer:
+                for point_table in point_tables:
+                    writer.write_table(point_table)  # One row group per point
+        t1 = time.time()
+        print(f"Saved file {file_path} in {t1 - t0:.2f} seconds")
+
+    def load_data(self, file_path: str, legacy: bool = False):
+        """Opens a saved Parquet file lazily; points are read with load_point_data.
+
+        With legacy=True the whole dictionary is loaded from an lz4 compressed pickle.
+        """
+        t0 = time.time()
+        if legacy:
+            with lz4.frame.open(file_path, "rb") as f:
+                data = pickle.load(f)
+        else:
+            data = ds.dataset(file_path, format="parquet")
+        t1 = time.time()
+        print(f"Loaded file {file_path} in {t1 - t0:.2f} seconds")
+        return data
+
+    def load_lat_lon_table(self, file_path: str):
+        """Loads the point id -> (lat, lon) table saved next to a data file."""
+        return np.load(f"{file_path}.lat_lon_table.npy")
+
+    def load_point_data(self, dataset: ds.Dataset, point_id: int):
+        """Reads the time series of a single point from a dataset opened by load_data."""
+        table = dataset.to_table(filter=pc.field("point_id") == point_id)
+        return table.to_pandas().drop(columns="point_id").set_index("iso-date")
 
 
 
 if __name__ == "__main__":
     extractor = ClimateDataExtractor()
     max_points = 2000
-    ndarray_of_valid_lat_lon_tuples = np.load("valid_grid_points.npy")
+    ndarray_of_valid_lat_lon_tuples = np.load(
+        "valid_grid_points.npy", mmap_mode="r"
+    )
 
-    amber_data_file = f"cache/amber/2023_2024_{max_points}_points_extracted.pkl.lz4"
-    forecast_data_file = f"cache/forecast/r1i1p1_{max_points}_points_extracted.pkl.lz4"
+    amber_data_file = f"2023_2024_{max_points}_points_extracted.parquet"
+    forecast_data_file = f"r1i1p1_{max_points}_points_extracted.parquet"
 
 
     amber_df_dict = extractor.extract_amber_data(
@@ -175,7 +477,12 @@ if __name__ == "__main__":
         ndarray_of_valid_lat_lon_tuples=ndarray_of_valid_lat_lon_tuples,
         max_points=max_points,
     )
-    extractor.save_data(amber_df_dict, amber_data_file)
+    extractor.save_data(
+        amber_df_dict,
+        "cache/amber",
+        amber_data_file,
+        lat_lon_table=ndarray_of_valid_lat_lon_tuples[:max_points],
+    )
 
     forecast_df_dict = extractor.extract_forecast_data(
         netcdf_folder_pattern="netcdf_files/forecasts/20240501/{ensemble}",
@@ -183,10 +490,15 @@ if __name__ == "__main__":
         file_name_pattern="merged_20240501_{ensemble}.nc",
         ndarray_of_valid_lat_lon_tuples=ndarray_of_valid_lat_lon_tuples,
         max_points=max_points,
-        ensemble="r1i1p1",
+        ensembles=["r1i1p1"],
     )
 
-    extractor.save_data(forecast_df_dict,forecast_data_file)
+    extractor.save_data(
+        forecast_df_dict["r1i1p1"],
+        "cache/forecast",
+        forecast_data_file,
+        lat_lon_table=ndarray_of_valid_lat_lon_tuples[:max_points],
+    )
 
     print(len(amber_df_dict))
     print(next(iter(amber_df_dict.values())))
\ No newline at end of file
@@ -6,36 +6,15 @@ from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import xarray as xr
 import numpy as np
+from ClimateDataExtractor import ClimateDataExtractor as BulkClimateDataExtractor
 
 
-class ClimateDataExtractor:
+class ClimateDataExtractor(BulkClimateDataExtractor):
     def __init__(self):
+        super().__init__()
         self.historical_ds = None
         self.forecast_ds = None
 
-    def _convert_forecast_to_historical_units(self, forecast_df: pd.DataFrame):
-        """Converts forecast data units to match historical data units."""
-        forecast_df[["tas", "tasmax", "tasmin"]] -= 273.15  # Kelvin to Celsius
-        forecast_df[["rsds"]] *= 24  # Daily mean to total daily radiation
-        return forecast_df
-
-    def _extract_point_data(
-        self, dataset: xr.Dataset, lat: float, lon: float, variables: list[str]
-    ):
-        """Extracts time series data for specified variables at a lat/lon."""
-        df = dataset[variables].sel(lat=lat, lon=lon, method="nearest").to_dataframe()
-        df["iso-date"] = pd.to_datetime(df.index).date  
-        return df.set_index("iso-date")[variables]
-
-    def _combine_dataframes(
-        self, historical_df: pd.DataFrame, forecast_df: pd.DataFrame
-    ):
-        """Combines historical and forecast dataframes, removing overlaps."""
-        last_valid_historical = historical_df.last_valid_index()
-        historical_df = historical_df.loc[:last_valid_historical]
-        combined_df = pd.concat([historical_df, forecast_df], axis=0)
-        return combined_df[~combined_df.index.duplicated(keep="first")]
-
     def _load_netcdf_data(self, folder: str, file_pattern: str, start_year: int, end_year: int):
         """Loads NetCDF files within the year range into an xarray dataset."""
         file_paths = []
@@ -49,21 +28,57 @@ class ClimateDataExtractor:
             return None
         return xr.open_mfdataset(file_paths)
 
+    def _lat_lon_table(self, lats: np.ndarray, lons: np.ndarray):
+        """Builds the point id -> (lat, lon) table for the extracted points."""
+        lat_lon_table = np.empty(
+            len(lats), dtype=np.dtype([("lat", lats.dtype), ("lon", lons.dtype)])
+        )
+        lat_lon_table["lat"] = lats
+        lat_lon_table["lon"] = lons
+        return lat_lon_table
+
     def _process_point_batch(
-        self, historical_ds, forecast_ds, variables, lat_batch, lon_batch, max_points=None
+        self,
+        historical_ds,
+        forecast_ds,
+        variables,
+        lat_batch,
+        lon_batch,
+        first_point_id=0,
+        max_points=None,
     ):
-        """Processes a batch of points, optionally limiting the total processed points."""
+        """Processes a batch of points, optionally limiting the total processed points.
+
+        Results are keyed by point id, counted from first_point_id.
+        """
         batch_start_time = time.time()
+        lat_batch = lat_batch[: max_points or None]
+        lon_batch = lon_batch[: max_points or None]
+
+        # One gather per dataset, reading only the chunks that cover the points
+        historical_dates, historical_values = self._gather_points(
+            historical_ds, lat_batch, lon_batch, variables
+        )
+        forecast_dates, forecast_values = self._gather_points(
+            forecast_ds, lat_batch, lon_batch, variables
+        )
+        self._convert_forecast_to_amber_units(forecast_values, variables)
+
+        historical_days = self._day_numbers(historical_dates)
+        forecast_days = self._day_numbers(forecast_dates)
+
         batch_results = {}
-        for i, (lat, lon) in enumerate(zip(lat_batch, lon_batch)):
-            if max_points and i >= max_points:
-                break  # Stop if max_points limit is reached within the batch
-
-            historical_df = self._extract_point_data(historical_ds, lat, lon, variables)
-            forecast_df = self._extract_point_data(forecast_ds, lat, lon, variables)
-            forecast_df = self._convert_forecast_to_historical_units(forecast_df)
-            batch_results[f"{lat},{lon}"] = self._combine_dataframes(
-                historical_df, forecast_df
+        for i in range(len(lat_batch)):
+            index, values = self._combine_arrays(
+                historical_dates,
+                historical_days,
+                historical_values[:, :, i].T,
+                forecast_dates,
+                forecast_days,
+                forecast_values[:, :, i].T,
+            )
+            batch_results[first_point_id + i] = pd.DataFrame(
+                values, index=index, columns=variables
             )
         batch_end_time = time.time()
         print(f"Batch processed in {batch_end_time - batch_start_time:.2f} seconds")
@@ -79,51 +94,44 @@ class ClimateDataExtractor:
         mask_path: str,
         max_points: int = None,
     ):
-        """Extracts and combines data for valid grid points."""
+        """Extracts and combines data for valid grid points.
+
+        Returns {point: df} and the point id -> (lat, lon) table.
+        """
         mask = np.load(mask_path)
 
         self.historical_ds = self._load_netcdf_data(
             netcdf_folder, file_name_pattern, start_year, end_year
-        ).load()
+        )
         self.forecast_ds = self._load_netcdf_data(
             "netcdf_files/forecasts_2024_05/r1i1p1", "combined.nc", 2024, 2024
-        ).load()
+        )
 
-        if not self.historical_ds or not self.forecast_ds:
-            return {}
+        if self.historical_ds is None or self.forecast_ds is None:
+            for dataset in (self.historical_ds, self.forecast_ds):
+                if dataset is not None:
+                    dataset.close()
+            return {}, self._lat_lon_table(np.empty(0), np.empty(0))
 
-        lats, lons = self.historical_ds["lat"].values, self.historical_ds["lon"].values
-        lon_grid, lat_grid = np.meshgrid(lons, lats)
         valid_lat_indices, valid_lon_indices = np.where(mask)
+        valid_lat_indices = valid_lat_indices[: max_points or None]
+        valid_lon_indices = valid_lon_indices[: max_points or None]
+        lats = self.historical_ds["lat"].values[valid_lat_indices]
+        lons = self.historical_ds["lon"].values[valid_lon_indices]
 
-        df_dict = {}
         start_time = time.time()
-        for count, (lat_idx, lon_idx) in enumerate(
-            zip(valid_lat_indices, valid_lon_indices)
-        ):
-            if max_points and count >= max_points:
-                break  # Stop processing if max_points limit is reached
-
-            lat, lon = lat_grid[lat_idx, lon_idx], lon_grid[lat_idx, lon_idx]
 
-            historical_df = self._extract_point_data(
-                self.historical_ds, lat, lon, variables
-            )
-            forecast_df = self._extract_point_data(
-                self.forecast_ds, lat, lon, variables
-            )
-            forecast_df = self._convert_forecast_to_historical_units(forecast_df.copy())
-
-            df_dict[f"{lat},{lon}"] = self._combine_dataframes(
-                historical_df, forecast_df
-            )
+        # The same gather and combine as each parallel batch, over all points
+        df_dict = self._process_point_batch(
+            self.historical_ds, self.forecast_ds, variables, lats, lons
+        )
 
         self.historical_ds.close()
         self.forecast_ds.close()
         print(
-            f"Processed {count + 1} points in {time.time() - start_time:.2f} seconds."
+            f"Processed {len(df_dict)} points in {time.time() - start_time:.2f} seconds."
         )
-        return df_dict
+        return df_dict, self._lat_lon_table(lats, lons)
 
     def extract_variables_over_years_parallel(
         self,
@@ -136,8 +144,11 @@ class ClimateDataExtractor:
         batch_size: int = None,
         max_points: int = None,  # Add max_points parameter here
     ):
-        """Extracts and combines data for valid grid points, processing in batches."""
-        
+        """Extracts and combines data for valid grid points, processing in batches.
+
+        Returns {point: df} and the point id -> (lat, lon) table.
+        """
+
         mask = np.load(mask_path)
 
         # Calculate batch size if not provided
@@ -153,8 +164,11 @@ class ClimateDataExtractor:
             "netcdf_files/forecasts_2024_05/r1i1p1", "combined.nc", 2024, 2024
         )
 
-        if not self.historical_ds or not self.forecast_ds:
-            return {}
+        if self.historical_ds is None or self.forecast_ds is None:
+            for dataset in (self.historical_ds, self.forecast_ds):
+                if dataset is not None:
+                    dataset.close()
+            return {}, self._lat_lon_table(np.empty(0), np.empty(0))
 
         lats, lons = self.historical_ds["lat"].values, self.historical_ds["lon"].values
         lon_grid, lat_grid = np.meshgrid(lons, lats)
@@ -188,6 +202,7 @@ class ClimateDataExtractor:
                         variables,
                         lat_batch,
                         lon_batch,
+                        first_point_id=i,
                         max_points=(max_points - points_processed)
                         if max_points
                         else None,  # Adjust max_points for each batch
@@ -204,13 +219,18 @@ class ClimateDataExtractor:
         print(
             f"Processed {len(df_dict)} points in {time.time() - start_time:.2f} seconds."
         )
-        return df_dict
+        # Point ids are positions in the valid points, so the table is their prefix
+        lat_lon_table = self._lat_lon_table(
+            lats[valid_lat_indices[: len(df_dict)]],
+            lons[valid_lon_indices[: len(df_dict)]],
+        )
+        return df_dict, lat_lon_table
 
 
 if __name__ == "__main__":
     extractor = ClimateDataExtractor()
     max_points = 2000
-    # df_dict = extractor.extract_variables_over_years(
+    # df_dict, lat_lon_table = extractor.extract_variables_over_years(
     #     netcdf_folder="netcdf_files/combined",
     #     variables=["hurs", "pr", "rsds", "sfcWind", "tas", "tasmax", "tasmin"],
     #     file_name_pattern="zalf_combined_amber_{year}_v1-0_uncompressed.nc",
@@ -220,7 +240,7 @@ if __name__ == "__main__":
     #     max_points=max_points
     # )
 
-    df_dict = extractor.extract_variables_over_years_parallel(
+    df_dict, lat_lon_table = extractor.extract_variables_over_years_parallel(
         netcdf_folder="netcdf_files/combined",
         variables=["hurs", "pr", "rsds", "sfcWind", "tas", "tasmax", "tasmin"],
         file_name_pattern="zalf_combined_amber_{year}_v1-0_uncompressed.nc",
@@ -231,7 +251,11 @@ if __name__ == "__main__":
         max_points=max_points  # Pass max_points to the parallel method
     )
     print(len(df_dict))
-    df = df_dict["54.80027617931778,9.647312950670669"]
+    point_id = np.flatnonzero(
+        np.isclose(lat_lon_table["lat"], 54.80027617931778)
+        & np.isclose(lat_lon_table["lon"], 9.647312950670669)
+    )[0]
+    df = df_dict[point_id]
     print(df)
 
     with open(f"{max_points}_points_extracted.pkl", "wb") as f:
@@ -1,30 +1,99 @@
 import os
+import json
+import shutil
+import subprocess
 
+import h5py
 import xarray as xr
 import glob
+from kerchunk.hdf import SingleHdf5ToZarr
 
 class NetCDFMerger:
     def __init__(self):
         # You might not need any initialization here, but you can add if necessary
         pass 
 
-    def _merge_netcdf_files(self, file_pattern, output_file):
+    def _is_split_along_time(self, files):
+        """Checks that the files hold the same variables with time as the record dimension.
+
+        Only then can they be concatenated record by record (ncrcat).
+        """
+        layouts = set()
+        for file in files:
+            # Opening reads only the metadata
+            with xr.open_dataset(file, decode_cf=False) as dataset:
+                if "time" not in dataset.encoding.get("unlimited_dims", ()):
+                    return False
+                layouts.add(frozenset(dataset.data_vars))
+        return len(layouts) == 1
+
+    def _merge_netcdf_files(
+        self,
+        file_pattern,
+        output_file,
+        merge_command,
+        write_references=False,
+        record_command=None,
+    ):
         """Merges multiple netCDF files matching a pattern into a single file.
 
         Args:
             file_pattern (str): A glob pattern to match the netCDF files.
             output_file (str): The path to save the merged netCDF file.
+            merge_command (list[str]): Command line tool (e.g. cdo merge) that merges
+                the files without decoding them; the input files and the output file are
+                appended. Falls back to xarray if the tool is not installed.
+            write_references (bool): Also write a Kerchunk reference file for the
+                merged file.
+            record_command (list[str]): Command (e.g. ncrcat) used instead of
+                merge_command when the files are split along the time record dimension.
         """
-        files = [f for f in glob.glob(file_pattern) if "merged_" not in os.path.basename(f)]
+        files = sorted(
+            f for f in glob.glob(file_pattern) if "merged_" not in os.path.basename(f)
+        )
         if files:
-            datasets = [xr.open_dataset(file) for file in files]
-            merged_dataset = xr.merge(datasets, compat="override")
-            encoding = {var: {"zlib": False} for var in merged_dataset.data_vars}
-            merged_dataset.to_netcdf(output_file, encoding=encoding)
+            split_along_time = record_command is not None and self._is_split_along_time(
+                files
+            )
+            command = record_command if split_along_time else merge_command
+            if shutil.which(command[0]):
+                subprocess.run([*command, *files, output_file], check=True)
+            else:
+                datasets = [xr.open_dataset(file) for file in files]
+                if split_along_time:
+                    merged_dataset = xr.concat(
+                        datasets,
+                        dim="time",
+                        data_vars="minimal",
+                        coords="minimal",
+                        compat="override",
+                    )
+                else:
+                    merged_dataset = xr.merge(datasets, compat="override")
+                # Keep each variable's source encoding (compression, chunking)
+                merged_dataset.to_netcdf(output_file)
             print(f"Merged files to: {output_file}")
+            if write_references:
+                self._write_reference_file(output_file)
         else:
             print(f"No files found matching pattern: {file_pattern}")
 
+    def _write_reference_file(self, netcdf_file):
+        """Writes a Kerchunk reference file (<netcdf_file>.json) next to a merged file.
+
+        The references let readers open the file through zarr and fetch only the
+        chunks they need, without the HDF5 library. Skipped for non-HDF5 files.
+        """
+        reference_file = f"{netcdf_file}.json"
+        if not h5py.is_hdf5(netcdf_file):
+            if os.path.exists(reference_file):
+                os.remove(reference_file)  # Stale references from an earlier merge
+            return
+        # Absolute paths keep the references valid from any working directory
+        references = SingleHdf5ToZarr(os.path.abspath(netcdf_file)).translate()
+        with open(reference_file, "w") as f:
+            json.dump(references, f)
+
     def merge_esgf_files(self, base_dir: str, year: int, month: int, ensembles: list[str]):
         """Merges ESGF netCDF files for a single year-month combination and all ensembles.
 
@@ -41,7 +110,13 @@ class NetCDFMerger:
                 ensemble_dir = os.path.join(start_date_dir, ensemble)
                 file_pattern = os.path.join(ensemble_dir, "*.nc")
                 output_file = os.path.join(ensemble_dir, f"merged_{start_date_str}_{ensemble}.nc")
-                self._merge_netcdf_files(file_pattern, output_file)
+                # One file per variable: merge variables on the shared grid
+                self._merge_netcdf_files(
+                    file_pattern,
+                    output_file,
+                    ["cdo", "-O", "merge"],
+                    write_references=True,
+                )
 
     def merge_amber_files(self, base_dir: str, start_year: int, end_year: int):
         """Merges AMBER netCDF files organized by year.
@@ -54,4 +129,12 @@ class NetCDFMerger:
         for year in range(start_year, end_year + 1):
             file_pattern = os.path.join(base_dir, str(year), "*.nc")
             output_file = os.path.join(base_dir, str(year), f"zalf_merged_amber_{year}_v1-0.nc")
-            self._merge_netcdf_files(file_pattern, output_file)
\ No newline at end of file
+            # Year folders may hold one file per variable (as the xarray merge
+            # assumed) or time slices of all variables; only the latter are
+            # concatenated along the record dimension
+            self._merge_netcdf_files(
+                file_pattern,
+                output_file,
+                ["cdo", "-O", "merge"],
+                record_command=["ncrcat", "-h", "-O"],
+            )
\ No newline at end of file
@@ -2,12 +2,21 @@ import numpy as np
 from ClimateDataDownloader import ClimateDataDownloader
 from ClimateDataExtractor import ClimateDataExtractor
 from NetCDFMerger import NetCDFMerger
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import dotenv
 import os
 
 dotenv.load_dotenv()
 
 
+def _merge_ensemble(forecast_directory: str, year: int, month: int, ensemble: str):
+    """Merges the forecast files of one ensemble in a worker process."""
+    NetCDFMerger().merge_esgf_files(
+        base_dir=forecast_directory, year=year, month=month, ensembles=[ensemble]
+    )
+
+
 class NetCDFToMonicaPipeline:
     def __init__(self):
         self.downloader = ClimateDataDownloader()
@@ -36,27 +45,50 @@ class NetCDFToMonicaPipeline:
             year=year,
             target_folder=forecast_directory,
         )
-        self.merger.merge_esgf_files(
-            base_dir=forecast_directory, year=year, month=month, ensembles=ensembles
-        )
+        # Ensembles are independent datasets; each worker opens its own files
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(
+                executor.map(
+                    partial(_merge_ensemble, forecast_directory, year, month),
+                    ensembles,
+                )
+            )
 
-        ndarray_of_valid_lat_lon_tuples = np.load("valid_grid_points.npy")
+        max_points = 2000
+        ndarray_of_valid_lat_lon_tuples = np.load(
+            "valid_grid_points.npy", mmap_mode="r"
+        )
+        lat_lon_table = ndarray_of_valid_lat_lon_tuples[:max_points]
 
-        for enseble in ensembles:
-            forecast_data_directory = f"cache/forecast/{year}{month:02}01"
-            forecast_data_file = f"{enseble}_extracted.pkl.lz4"
+        forecast_data_directory = f"cache/forecast/{year}{month:02}01"
 
-            forecast_df_dict = self.extractor.extract_forecast_data(
-                netcdf_folder_pattern="netcdf_files/forecasts/20240501/{ensemble}",
-                variables=variables,
-                file_name_pattern="merged_20240501_{ensemble}.nc",
-                ndarray_of_valid_lat_lon_tuples=ndarray_of_valid_lat_lon_tuples,
-                ensemble=enseble,
-                max_points=2000,
+        # All ensembles are opened as one dataset and gathered in a single pass
+        ensemble_df_dicts = self.extractor.extract_forecast_data(
+            netcdf_folder_pattern="netcdf_files/forecasts/20240501/{ensemble}",
+            variables=variables,
+            file_name_pattern="merged_20240501_{ensemble}.nc",
+            ndarray_of_valid_lat_lon_tuples=ndarray_of_valid_lat_lon_tuples,
+            ensembles=ensembles,
+            max_points=max_points,
+        )
+        for ensemble, forecast_df_dict in ensemble_df_dicts.items():
+            self._persist(
+                ensemble, forecast_df_dict, forecast_data_directory, lat_lon_table
             )
 
+    def _persist(
+        self,
+        ensemble: str,
+        forecast_df_dict: dict,
+        directory_name: str,
+        lat_lon_table: np.ndarray,
+    ):
+        """Saves the extracted forecast points of one ensemble."""
         self.extractor.save_data(
-            forecast_df_dict, forecast_data_directory, forecast_data_file
+            forecast_df_dict,
+            directory_name,
+            f"{ensemble}_extracted.parquet",
+            lat_lon_table=lat_lon_table,
         )
 
     def amber_pipeline(
@@ -81,9 +113,12 @@ class NetCDFToMonicaPipeline:
             base_dir=amber_directory, start_year=start_year, end_year=end_year
         )
 
-        ndarray_of_valid_lat_lon_tuples = np.load("valid_grid_points.npy")
+        max_points = 2000
+        ndarray_of_valid_lat_lon_tuples = np.load(
+            "valid_grid_points.npy", mmap_mode="r"
+        )
         amber_data_directory = f"cache/amber"
-        amber_data_file = f"{start_year}_to_{end_year}_extracted.pkl.lz4"
+        amber_data_file = f"{start_year}_to_{end_year}_extracted.parquet"
 
         amber_df_dict = self.extractor.extract_amber_data(
             netcdf_folder_pattern="netcdf_files/amber/{year}",
@@ -92,9 +127,14 @@ class NetCDFToMonicaPipeline:
             start_year=start_year,
             end_year=end_year,
             ndarray_of_valid_lat_lon_tuples=ndarray_of_valid_lat_lon_tuples,
-            max_points=2000,
+            max_points=max_points,
+        )
+        self.extractor.save_data(
+            amber_df_dict,
+            amber_data_directory,
+            amber_data_file,
+            lat_lon_table=ndarray_of_valid_lat_lon_tuples[:max_points],
         )
-        self.extractor.save_data(amber_df_dict, amber_data_directory, amber_data_file)
 
 
 if __name__ == "__main__":
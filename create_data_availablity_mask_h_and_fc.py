@@ -1,49 +1,164 @@
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4
 import numpy as np
-import xarray as xr
+from grid_utils import nearest_indices
+
+try:
+    from numba import njit, prange
+
+    HAS_NUMBA = True
+except ImportError:  # Fall back to NumPy reductions in worker processes
+    HAS_NUMBA = False
+
+# Latitude rows read per block; each block holds the whole time series
+ROW_BLOCK = 128
+
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def _has_valid_sample(pr: np.ndarray, out: np.ndarray):
+        """Marks the (lat, lon) cells of a (lat, lon, time) array with any value."""
+        n_lat, n_lon, n_time = pr.shape
+        for i in prange(n_lat):
+            for j in range(n_lon):
+                found = False
+                for t in range(n_time):
+                    if not np.isnan(pr[i, j, t]):
+                        found = True
+                        break  # One valid sample is enough
+                out[i, j] = found
+
+
+def _block_has_data(block: np.ndarray):
+    """Marks the (lat, lon) cells of one (time, lat, lon) block with any value."""
+    # The reduction is memory bound, so the reduced axis is made unit stride
+    # for the kernel's per-cell loop and outermost for the NumPy reduction
+    if not HAS_NUMBA:
+        block = np.ascontiguousarray(block)
+        # A finite minimum over time proves at least one valid sample
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # All-NaN cells
+            return np.isfinite(np.nanmin(block, axis=0))
+    out = np.empty(block.shape[1:], dtype=np.bool_)
+    _has_valid_sample(
+        np.ascontiguousarray(block.transpose(1, 2, 0), dtype=np.float32), out
+    )
+    return out
+
+
+def _read_coords(path: str):
+    """Reads the raw lat and lon coordinate vectors of a NetCDF file."""
+    with netCDF4.Dataset(path) as nc:
+        nc.set_auto_mask(False)
+        return nc.variables["lat"][:], nc.variables["lon"][:]
+
+
+def _read_pr_rows(path: str, row_start: int, row_stop: int):
+    """Reads pr for a range of lat rows as a float32 (time, lat, lon) array."""
+    with netCDF4.Dataset(path) as nc:
+        pr = nc.variables["pr"]
+        # Only missing samples matter here, so skip CF masking and scaling
+        pr.set_auto_maskandscale(False)
+        rows = pr[
+            tuple(
+                slice(row_start, row_stop) if dim == "lat" else slice(None)
+                for dim in pr.dimensions
+            )
+        ]
+        rows = rows.transpose([pr.dimensions.index(d) for d in ("time", "lat", "lon")])
+        missing = np.zeros(rows.shape, dtype=np.bool_)
+        for attr in ("_FillValue", "missing_value"):
+            if attr in pr.ncattrs():
+                # Compare in the variable's dtype, as netCDF4's own masking does
+                fill = np.asarray(pr.getncattr(attr), dtype=rows.dtype)
+                missing |= np.isin(rows, np.atleast_1d(fill))
+    return np.where(missing, np.nan, rows).astype(np.float32, copy=False)
+
+
+def _rows_have_data(path: str, row_start: int, row_stop: int):
+    """Marks the (lat, lon) cells of a range of lat rows where pr has any value."""
+    return _block_has_data(_read_pr_rows(path, row_start, row_stop))
+
+
+def _has_data(path: str):
+    """Builds a (lat, lon) mask of cells where pr has any value over time."""
+    with netCDF4.Dataset(path) as nc:
+        n_lat = len(nc.dimensions["lat"])
+    row_starts = range(0, n_lat, ROW_BLOCK)
+    row_stops = [min(start + ROW_BLOCK, n_lat) for start in row_starts]
+    if HAS_NUMBA:
+        # The kernel is already parallel, so row blocks are read one by one
+        blocks = map(_rows_have_data, [path] * len(row_stops), row_starts, row_stops)
+        return np.concatenate(list(blocks), axis=0)
+    # Each worker opens the file itself and reduces its own row blocks
+    with ProcessPoolExecutor() as executor:
+        blocks = executor.map(
+            _rows_have_data, [path] * len(row_stops), row_starts, row_stops
+        )
+        return np.concatenate(list(blocks), axis=0)
+
+
+def _valid_grid_indices(valid: np.ndarray):
+    """Builds the structured (i, j) grid index array of the True cells of a mask."""
+    if max(valid.shape) >= np.iinfo(np.int16).max:
+        raise ValueError(f"Grid of shape {valid.shape} is too large for int16 indices")
+    ii, jj = np.nonzero(valid)
+    valid_grid_indices = np.empty(
+        ii.size, dtype=np.dtype([("i", np.int16), ("j", np.int16)])
+    )
+    valid_grid_indices["i"] = ii
+    valid_grid_indices["j"] = jj
+    return valid_grid_indices
 
 
 def save_valid_grid_points_fc_and_hist(
-    dataset_fc: xr.Dataset, dataset_hist: xr.Dataset, output_path: str
+    fc_path: str, hist_path: str, output_path: str
 ):
     """
-    Saves the (lat, lon) tuples of valid grid points present in both
-    forecast and historical datasets to a NumPy file.
+    Saves the mask and the (i, j) grid indices of valid grid points present in
+    both forecast and historical NetCDF files, with the lat/lon vectors, to a
+    NumPy .npz file.
     """
-    dataset_fc.load()
-    dataset_hist.load()
-    lats = dataset_hist["lat"]
-    lons = dataset_hist["lon"]
-    variables = ["hurs", "pr", "rsds", "sfcWind", "tas", "tasmax", "tasmin"]
-
-    valid_grid_points = []
-    for i in range(len(lats)):
-        for j in range(len(lons)):
-            lat = lats[i].values
-            lon = lons[j].values
-            data_point_hist = dataset_hist[variables].sel(
-                lat=lat, lon=lon, method="nearest"
-            )
-            data_point_fc = dataset_fc[variables].sel(
-                lat=lat, lon=lon, method="nearest"
-            )
-            if not (
-                data_point_hist["pr"].isnull().all()
-                or data_point_fc["pr"].isnull().all()
-            ):
-                valid_grid_points.append((lat, lon))
-
-    # Create a structured array for efficient storage
-    valid_grid_points = np.array(
-        valid_grid_points,
-        dtype=np.dtype([("lat", np.float32), ("lon", np.float32)])
+    # A grid point is valid if pr has at least one value in both files.
+    # Only the raw pr samples and the coordinates are read, block by block.
+    has_data_hist = _has_data(hist_path)
+    has_data_fc = _has_data(fc_path)
+    lats, lons = _read_coords(hist_path)
+    fc_lats, fc_lons = _read_coords(fc_path)
+
+    # Nearest forecast cell for every historical row and column
+    fc_i = nearest_indices(fc_lats, lats)
+    fc_j = nearest_indices(fc_lons, lons)
+    valid = has_data_hist & has_data_fc[np.ix_(fc_i, fc_j)]
+
+    # The (lat, lon) mask applies directly to gridded arrays; int16 grid indices
+    # take half the space of float32 lat/lon pairs and address cells exactly
+    np.savez_compressed(
+        output_path,
+        mask=valid,
+        points=_valid_grid_indices(valid),
+        lat=lats.astype(np.float32, copy=False),
+        lon=lons.astype(np.float32, copy=False),
     )
 
-    # Save the array to disk
-    np.save(output_path, valid_grid_points)
+
+def load_valid_points(path: str):
+    """Loads saved grid indices as the structured (lat, lon) array of valid points."""
+    with np.load(path) as valid_points:
+        points = valid_points["points"]
+        valid_grid_points = np.empty(
+            points.size, dtype=np.dtype([("lat", np.float32), ("lon", np.float32)])
+        )
+        valid_grid_points["lat"] = valid_points["lat"][points["i"]]
+        valid_grid_points["lon"] = valid_points["lon"][points["j"]]
+    return valid_grid_points
 
 
-dataset_fc = xr.open_dataset("netcdf_files/forecasts/20240501/r1i1p1/merged_20240501_r1i1p1.nc")
-dataset_hist = xr.open_dataset("netcdf_files/amber/2024/zalf_merged_amber_2024_v1-0.nc")
-save_valid_grid_points_fc_and_hist(
-    dataset_fc, dataset_hist, "valid_grid_points_fc_and_hist.npy"
-)
\ No newline at end of file
+if __name__ == "__main__":
+    save_valid_grid_points_fc_and_hist(
+        "netcdf_files/forecasts/20240501/r1i1p1/merged_20240501_r1i1p1.nc",
+        "netcdf_files/amber/2024/zalf_merged_amber_2024_v1-0.nc",
+        "valid_grid_points_fc_and_hist.npz",
+    )
\ No newline at end of file
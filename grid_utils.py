@@ -0,0 +1,14 @@
+import numpy as np
+
+
+def nearest_indices(coords: np.ndarray, values: np.ndarray):
+    """Maps values to the indices of their nearest coordinates on a monotonic axis."""
+    if coords.size == 1:
+        return np.zeros(len(values), dtype=np.intp)
+    # Coordinates may be descending (e.g. lat); search on the ascending view
+    descending = coords[0] > coords[-1]
+    ascending = coords[::-1] if descending else coords
+    right = np.clip(np.searchsorted(ascending, values), 1, ascending.size - 1)
+    left = right - 1
+    nearest = np.where(values - ascending[left] <= ascending[right] - values, left, right)
+    return ascending.size - 1 - nearest if descending else nearest